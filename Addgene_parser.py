@@ -10,29 +10,172 @@
         genebank file and csv attributes of the plasmid.
 
 """
+import asyncio
+import csv
 import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from lxml import etree
 import requests
-import pandas as pd
-import urllib.request as request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 from typing import Callable, Any
 from requests.exceptions import ConnectionError
 from httpx import TransportError
 from time import sleep
-from math import log2
-
-REQUESTS_RETRY_COUNT = 623
-_REQUEST_STEP_BASE_DELAY = 60
+import random
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None  # the parser falls back to a thread pool over requests
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None  # optional, caches responses on disk between development runs
+
+REQUESTS_RETRY_COUNT = 10
+_REQUEST_MAX_DELAY = 300
+_CONNECTIONS_PER_HOST = 8
+
+# The extractors only ever look at these nodes, so skip the rest of the DOM while parsing
+_MAIN_STRAINER = SoupStrainer(['span', 'li', 'h1', 'title'])
+
+# Labels of the li.field entries that get extracted from a plasmid page
+_FIELD_LABELS = ('Vector backbone', 'Vector type', 'Selectable markers', 'Bacterial Resistance(s)',
+                 'Growth Temperature', 'Growth Strain(s)', 'Growth instructions', 'Copy number',
+                 'Gene/Insert name', 'Total vector size (bp)')
+_FIELD_LABEL_WORDS = tuple((label, label.split()) for label in _FIELD_LABELS)
+_FIELD_LABEL_SET = frozenset(_FIELD_LABELS)
+
+# Plasmid attribute -> field label and the slice of the li token list holding its value
+_FIELDS = (('vector_type', 'Vector type', slice(2, None)),
+           ('marker', 'Selectable markers', slice(2, None)),
+           ('resistance', 'Bacterial Resistance(s)', slice(2, None)),
+           ('growth_t', 'Growth Temperature', slice(2, None)),
+           ('growth_strain', 'Growth Strain(s)', slice(2, None)),
+           ('growth_instructions', 'Growth instructions', slice(2, None)),
+           ('copy_num', 'Copy number', slice(2, None)),
+           ('gene_insert', 'Gene/Insert name', slice(2, None)))
 
 
 def get_request_delay(iteration: float) -> float:
     """
     :param iteration:
-    :return:
+    :return: capped exponential delay with jitter, so parallel workers spread their retries
     """
-    return _REQUEST_STEP_BASE_DELAY + log2(iteration) * 10
+    return min(2 ** min(iteration, 8), _REQUEST_MAX_DELAY) * (0.5 + random.random())
+
+
+def _make_session() -> requests.Session:
+    """Build a requests.Session with a keep-alive connection pool and retries on 429/5xx.
+    With requests_cache installed the session also caches responses on disk for a day,
+    so repeated development runs over the same ids skip the network entirely"""
+    if requests_cache is not None:
+        session = requests_cache.CachedSession('addgene_cache', expire_after=86400)
+    else:
+        session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                          max_retries=Retry(total=3, backoff_factor=0.3,
+                                            status_forcelist=[429, 500, 502, 503, 504]))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_SESSION = None
+
+
+def _get_session() -> requests.Session:
+    """Return the shared module session, so keep-alive connections survive
+    across parser instances (db_creator builds one parser per 500-id batch)"""
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = _make_session()
+    return _SESSION
+
+
+def _is_sorry_page(doc) -> bool:
+    """Detect Addgene's "Sorry!" page that comes back for ids that do not exist.
+    Only the title and heading nodes are checked instead of every string in the document"""
+    for node in doc.find_all(['title', 'h1']):
+        if 'Sorry' in node.get_text():
+            return True
+    return False
+
+
+def _sorry_parsed() -> dict:
+    """The parse result for an id that does not exist"""
+    return {'sorry': True, 'name': None, 'fields': {}}
+
+
+def _extract_fields(doc) -> dict:
+    """Walk the li.field nodes once and key their token lists by field label.
+    The label is read from the field's own label node when one exists, which is a
+    single dict hit; prefix-matching the text tokens stays as the fallback"""
+    fields = {}
+    for li in doc.find_all('li', class_='field'):
+        tokens = li.text.split()
+        label_node = li.find(['strong', 'span', 'h4'])
+        if label_node is not None:
+            label = ' '.join(label_node.get_text().split()).rstrip(':')
+            if label in _FIELD_LABEL_SET:
+                fields[label] = tokens
+                continue
+        for label, words in _FIELD_LABEL_WORDS:
+            if tokens[:len(words)] == words:
+                fields[label] = tokens
+                break
+    return fields
+
+
+def _parse_main(html) -> dict:
+    """Parse the main plasmid page into plain picklable pieces, so the work can
+    run in a ProcessPoolExecutor worker while the event loop keeps fetching"""
+    # the Sorry! marker sits in the page head, so a substring test on the raw
+    # bytes rules out most missing ids without building a soup at all
+    if b'Sorry!' in html[:8192]:
+        return _sorry_parsed()
+    doc = BeautifulSoup(html, 'lxml', parse_only=_MAIN_STRAINER)
+    if _is_sorry_page(doc):
+        return _sorry_parsed()
+    name_node = doc.find('span', class_='material-name')
+    name = name_node.text if name_node is not None else None
+    return {'sorry': False, 'name': name, 'fields': _extract_fields(doc)}
+
+
+class _GenbankLinkTarget:
+    """lxml parser target that grabs the genbank-file-download href from the
+    sequences page without building a document tree"""
+
+    def __init__(self):
+        self.href = None
+
+    def start(self, tag, attrs):
+        if self.href is None and tag == 'a' and 'genbank-file-download' in (attrs.get('class') or ''):
+            self.href = attrs.get('href')
+
+    def close(self):
+        return self.href
+
+
+def _find_genbank_href(html):
+    """Stream the sequences page through a SAX-style parse and return the
+    GenBank download link, or None when the page has none"""
+    parser = etree.HTMLParser(target=_GenbankLinkTarget())
+    parser.feed(html)
+    return parser.close()
+
+
+def _decode_genbank(seq_file):
+    """Decode GenBank file bytes into text; the fetchers keep the raw bytes
+    and the writers call this lazily when a text form is actually needed"""
+    if isinstance(seq_file, (bytes, bytearray)):
+        seq_file = seq_file.decode('utf-8', errors="replace").replace("\x00", "\uFFFD")
+    return seq_file
 
 
 def _with_retry(func: Callable) -> Callable:
@@ -86,8 +229,8 @@ class Description:
        :type copy_num: str
        :param gene_insert: The insertion/gene name according to the authors
        :type gene_insert: str
-       :param sequence: Transformed gbk file into text; a sequence with annotations
-       :type sequence: str"""
+       :param sequence: Raw gbk file bytes; a sequence with annotations, decoded to text lazily
+       :type sequence: bytes"""
     name: str  # The name of the plasmid that is given on Addgene site
     id: int  # Vendor's plasmid identificator
     vendor: str  # Which vendor's site to parse
@@ -102,47 +245,53 @@ class Description:
     growth_instructions: str  # Some specified information about growth in bacteria
     copy_num: str  # The characteristic of the plasmid: the number of copies of a given plasmid in a cell.
     gene_insert: str  # The insertion/gene name according to the authors
-    sequence: str  # Transformed gbk file into text; a sequence with annotations
+    sequence: bytes  # Raw gbk file bytes; a sequence with annotations, decoded to text lazily
 
 
 class Plasmid(Description):
+    _ensured_dirs = set()
+    # one-pass replacement of characters that cannot appear in a file name
+    _SAFE_NAME_TABLE = str.maketrans({**{char: '-' for char in '<>:"/|?*\t\n\b'},
+                                      'Δ': 'delta', 'α': 'alpha', 'Α': 'alpha', '\\': 'back-slash'})
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+    def _ensure_dir(self, path, name=None):
+        """Create the Plasmids/<name> directory once per run, skipping repeated stat calls"""
+        plasmid_dir = os.path.join(path, 'Plasmids', name or self.name)
+        if plasmid_dir not in Plasmid._ensured_dirs:
+            os.makedirs(plasmid_dir, exist_ok=True)
+            Plasmid._ensured_dirs.add(plasmid_dir)
+        return plasmid_dir
+
     def to_csv(self, path):
-        if not os.path.isdir(path + f'Plasmids\\{self.name}'):
-            os.makedirs(path + f'Plasmids\\{self.name}')
-        with open(path + f'Plasmids\\{self.name}\\{self.name}_csv.txt', 'w', encoding='utf-8') as file:
-            file.write(pd.DataFrame.from_dict({k: [v] for k, v in self.__dict__.items()}).to_csv(index_label=False))
+        plasmid_dir = self._ensure_dir(path)
+        with open(os.path.join(plasmid_dir, f'{self.name}_csv.txt'), 'w', encoding='utf-8', newline='',
+                  buffering=1 << 20) as file:
+            writer = csv.writer(file)
+            writer.writerow(self.__dict__.keys())
+            writer.writerow(_decode_genbank(value) if key == 'sequence' else value
+                            for key, value in self.__dict__.items())
 
     def to_json(self, path):
-        if not os.path.isdir(path + f'Plasmids\\{self.name}'):
-            os.makedirs(path + f'Plasmids\\{self.name}')
-        with open(path + f'Plasmids\\{self.name}\\{self.name}.json', 'w', encoding='utf-8') as file:
-            file.write(json.dumps({k: [v] for k, v in self.__dict__.items()}))
+        plasmid_dir = self._ensure_dir(path)
+        with open(os.path.join(plasmid_dir, f'{self.name}.json'), 'w', encoding='utf-8',
+                  buffering=1 << 20) as file:
+            json.dump({k: [_decode_genbank(v) if k == 'sequence' else v] for k, v in self.__dict__.items()}, file)
 
     def to_txt(self, path, seq_file):
         if seq_file is None:
             return None
-        new_name = self.name
-        for char in self.name:
-            if char in '<>:"/|?*\t\n\b':
-                new_name = new_name.replace(char, '-')
-            elif char in 'Δ':
-                new_name = new_name.replace(char, 'delta')
-            elif char in '\\':
-                new_name = new_name.replace(char, 'back-slash')
-            elif char.lower() in 'α':
-                new_name = new_name.replace(char, 'alpha')
-        if not os.path.isdir(path + f'Plasmids\\{new_name}'):
-            os.makedirs(path + f'Plasmids\\{new_name}')
-        with open(path + f'Plasmids\\{new_name}\\{new_name}.txt', 'wb') as file:
+        new_name = self.name.translate(Plasmid._SAFE_NAME_TABLE)
+        plasmid_dir = self._ensure_dir(path, new_name)
+        if isinstance(seq_file, str):
+            seq_file = seq_file.encode('utf-8')
+        with open(os.path.join(plasmid_dir, f'{new_name}.txt'), 'wb', buffering=1 << 20) as file:
             file.write(seq_file)
 
 
 class PlasmidParser:
-    plasmid_list = []
-
     def __init__(self, id, base_url: str = "https://www.addgene.org/", id_start: int = id, id_end: int = None,
                  vendor: str = 'addgene',
                  path: str = f''):
@@ -152,189 +301,148 @@ class PlasmidParser:
         self.id_end = id_end
         self.vendor = vendor
         self.path = path
-        if isinstance(self.id, int):
-            self.url = self.base_url + f'{self.id}/'
-            self.doc, self.doc_seq = self.get_html()
-            self.seq_file = self.get_txt(self.doc_seq)
+        self.plasmid_list = []
+        id_list = [self.id] if isinstance(self.id, int) else self.id
+        seen = set()
+        id_list = [i for i in id_list if not (i in seen or seen.add(i))]
+        if aiohttp is not None:
+            fetched = asyncio.run(self._fetch_all(id_list))
+        else:
+            self._session = _get_session()
+            with ThreadPoolExecutor(max_workers=_CONNECTIONS_PER_HOST) as executor:
+                fetched = list(executor.map(self._fetch_one, id_list))
+        for plasmid_id, parsed, seq_file in fetched:
+            self.url = self.base_url + f'{plasmid_id}/'
+            self._parsed = parsed
+            self.seq_file = seq_file
 
-            self.get(self.id)
+            self.get(plasmid_id)
+
+    # only Addgene vendor is implemented yet
+    async def _fetch_all(self, id_list: list):
+        """Download all pages for id_list concurrently with one shared session,
+        handing main-page parsing off to a process pool"""
+        connector = aiohttp.TCPConnector(limit_per_host=_CONNECTIONS_PER_HOST)
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                tasks = [self._fetch_plasmid(session, pool, plasmid_id) for plasmid_id in id_list]
+                return await asyncio.gather(*tasks)
+
+    async def _fetch_plasmid(self, session, pool, plasmid_id: int):
+        url = self.base_url + f'{plasmid_id}/'
+        status, html = await self._fetch(session, url)
+        if status != 200:
+            return plasmid_id, _sorry_parsed(), None
+        parsed = await asyncio.get_running_loop().run_in_executor(pool, _parse_main, html)
+        if parsed['sorry']:
+            return plasmid_id, parsed, None
+        href = _find_genbank_href((await self._fetch(session, url + 'sequences/'))[1])
+        seq_file = await self._fetch_genbank(session, href)
+        return plasmid_id, parsed, seq_file
+
+    async def _fetch(self, session, url: str):
+        """GET url and return (status, body bytes), retrying on connection errors and 429/5xx"""
+        for i in range(REQUESTS_RETRY_COUNT + 1):
+            try:
+                async with session.get(url, headers={'User-Agent': 'Mozilla/5.0'}) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                          status=response.status, message=response.reason,
+                                                          headers=response.headers)
+                    return response.status, await response.read()
+            except aiohttp.ClientError as e:
+                if i == REQUESTS_RETRY_COUNT:
+                    raise e
+                retry_after = e.headers.get('Retry-After') if getattr(e, 'headers', None) else None
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else get_request_delay(i + 1)
+                # log here
+                print('Reconnecting.')
+                await asyncio.sleep(delay)
 
-        if isinstance(self.id, list):
-            for plasmid_id in self.id:
-                self.url = self.base_url + f'{plasmid_id}/'
-                self.doc, self.doc_seq = self.get_html()
-                self.seq_file = self.get_txt(self.doc_seq)
+    async def _fetch_genbank(self, session, href):
+        if href is None:
+            return None
+        return (await self._fetch(session, href))[1]
 
-                self.get(plasmid_id)
+    @_with_retry
+    def _fetch_one(self, plasmid_id: int):
+        """Blocking twin of _fetch_plasmid, run in a worker thread of the fallback pool"""
+        url = self.base_url + f'{plasmid_id}/'
+        response = self._session.get(url)
+        if response.status_code != 200:
+            return plasmid_id, _sorry_parsed(), None
+        parsed = _parse_main(response.content)
+        if parsed['sorry']:
+            return plasmid_id, parsed, None
+        href = _find_genbank_href(self._session.get(url + 'sequences/').content)
+        if href is None:
+            return plasmid_id, parsed, None
+        response = self._session.get(href, headers={'User-Agent': 'Mozilla/5.0'}, stream=True)
+        seq_bytes = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            seq_bytes += chunk
+        return plasmid_id, parsed, bytes(seq_bytes)
+
+    def flush_metadata(self, path: str = ''):
+        """Write the metadata of every parsed plasmid into a single JSONL file,
+        one line per plasmid, instead of one tiny file and directory each"""
+        with open(os.path.join(path, 'plasmids_metadata.jsonl'), 'w', encoding='utf-8') as file:
+            for plasmid in self.plasmid_list:
+                record = {k: v for k, v in plasmid.__dict__.items() if k != 'sequence'}
+                file.write(json.dumps(record) + '\n')
 
     @_with_retry
     def get(self, id: int):
         if self.sorry_defence():
             print(f"Sorry! There is no such id: {id}.")
             return None
-        elif self.get_name() is None:
+        name = self.get_name()
+        if name is None:
             return None
         else:
-            plasmid = Plasmid(name=self.get_name(), gene_insert=self.get_insert(),
-                              growth_instructions=self.get_growth_instructions(),
-                              copy_num=self.get_copy_number(), marker=self.get_marker(),
-                              growth_strain=self.get_growth_strain(), resistance=self.get_resistance(),
-                              vector_type=self.get_vector_type(),
-                              backbone=self.get_backbone(), id=id,
-                              vendor=self.vendor, url=self.url, growth_t=self.get_growth_t(),
-                              sequence=self.seq_file, size=self.get_size())
+            self._fields = self._parsed['fields']
+            values = {}
+            for attr, label, value_slice in _FIELDS:
+                tokens = self._fields.get(label)
+                values[attr] = None if tokens is None else ' '.join(tokens[value_slice])
+            plasmid = Plasmid(name=name, backbone=self.get_backbone(), id=id,
+                              vendor=self.vendor, url=self.url,
+                              sequence=self.seq_file, size=self.get_size(), **values)
             print(f'Getting {plasmid.name}, id: {plasmid.id}')
             # plasmid.to_csv(self.path) # Uncomment if you want to write down a text with csv
             # plasmid.to_json(self.path) # Uncomment if you want to write down a json file
             # plasmid.to_txt(self.path, self.seq_file)) # Uncomment if you want to write down gbk file
 
-            PlasmidParser.plasmid_list.append(plasmid)
+            self.plasmid_list.append(plasmid)
             return plasmid
 
-    # only Addgene vendor is implemented yet
-    @_with_retry
-    def get_html(self):
-        if self.vendor == 'addgene':
-            url_sequence = self.url + 'sequences/'
-            result_html = requests.get(self.url)
-            result_seq = requests.get(url_sequence)
-            return BeautifulSoup(result_html.text, 'html.parser'), BeautifulSoup(result_seq.text, 'html.parser')
-
-    @_with_retry
-    def get_txt(self, doc_seq):
-        tries = 3
-        try:
-            for i in range(tries + 1):
-                try:
-                    sequence = doc_seq.find_all('a', class_='genbank-file-download', href=True)[0]['href']
-                    req = request.Request(sequence, headers={'User-Agent': 'Mozilla/5.0'})
-                    seq_file = request.urlopen(req).read()
-                    if isinstance(seq_file, (bytes, bytearray)):
-                        seq_file = seq_file.decode('utf-8', errors="replace").replace("\x00", "\uFFFD")
-                    return seq_file
-                except (IndexError, ValueError) as e:
-                    pass
-            raise ValueError
-        except (IndexError, ValueError):
-            return None
-
     @_with_retry
     def sorry_defence(self):
         if self.vendor == 'addgene':
-            sorry = self.doc.find(string='Sorry!')
-            if sorry == 'Sorry!':
-                return True
-            else:
-                return False
+            return self._parsed['sorry']
 
     @_with_retry
     def get_name(self):
         # getting name
-        try:
-            name = self.doc.find('span', class_='material-name').text
-            return name
-        except AttributeError:
-            name = self.doc.find(string='Pooled Library')
+        name = self._parsed['name']
+        if name is None:
             print(f'Got Pooled Library, skip. ID: {self.id}. ')
-            return None
+        return name
 
     @_with_retry
     def get_backbone(self):
         # getting vector backbone
-        try:
-            backbone = ' '.join(
-                self.doc.find(string='Vector backbone').find_parent('li', class_='field').text.split()[-4::-1][-3::-1])
-        except AttributeError:
-            backbone = None
-        return backbone
-
-    @_with_retry
-    def get_vector_type(self):
-        # getting vector type
-        try:
-            vector_type = ' '.join(
-                self.doc.find(string='Vector type').find_parent('li', class_='field').text.split()[2::])
-        except AttributeError:
-            vector_type = None
-        return vector_type
-
-    @_with_retry
-    def get_marker(self):
-        # getting selectable markers
-        try:
-            marker = ' '.join(
-                self.doc.find(string='Selectable markers').find_parent('li', class_='field').text.split()[2::])
-        except AttributeError:
-            marker = None
-        return marker
-
-    @_with_retry
-    def get_resistance(self):
-        # getting bacterial resistance(s)
-        try:
-            resistance = ' '.join(
-                self.doc.find(string='Bacterial Resistance(s)').find_parent('li', class_='field').text.split()[2::])
-        except AttributeError:
-            resistance = None
-        return resistance
-
-    @_with_retry
-    def get_growth_t(self):
-        # getting Growth Temperature
-        try:
-            growth_t = ' '.join(
-                self.doc.find(string='Growth Temperature').find_parent('li', class_='field').text.split()[2::])
-        except AttributeError:
-            growth_t = None
-        return growth_t
-
-    @_with_retry
-    def get_growth_strain(self):
-        # getting Growth Strain(s)
-        try:
-            growth_strain = ' '.join(
-                self.doc.find(string='Growth Strain(s)').find_parent('li', class_='field').text.split()[2::])
-        except AttributeError:
-            growth_strain = None
-        return growth_strain
-
-    @_with_retry
-    def get_growth_instructions(self):
-        # getting Growth instructions
-        try:
-            growth_instructions = ' '.join(
-                self.doc.find(string='Growth instructions').find_parent('li', class_='field').text.split()[2::])
-        except AttributeError:
-            growth_instructions = None
-        return growth_instructions
-
-    @_with_retry
-    def get_copy_number(self):
-        # getting Copy number
-        try:
-            copy_num = ' '.join(self.doc.find(string='Copy number').find_parent('li', class_='field').text.split()[2::])
-        except AttributeError:
-            copy_num = None
-        return copy_num
-
-    @_with_retry
-    def get_insert(self):
-        # getting Gene/Insert name
-        try:
-            gene_insert = ' '.join(
-                self.doc.find(string='Gene/Insert name').find_parent('li', class_='field').text.split()[2::])
-        except AttributeError:
-            gene_insert = None
-        return gene_insert
+        tokens = self._fields.get('Vector backbone')
+        if tokens is None:
+            return None
+        # drop the two label words and the trailing "(Search Vector Database)" link text
+        return ' '.join(tokens[2:-3])
 
     @_with_retry
     def get_size(self):
         # getting Total vector size (bp)
-        try:
-            size = int(' '.join(
-                self.doc.find(string='Total vector size (bp)').find_parent('li', class_='field').text.split()[4::]))
-        except AttributeError:
-            size = None
+        tokens = self._fields.get('Total vector size (bp)')
+        size = int(' '.join(tokens[4::])) if tokens is not None else None
         # getting Total vector size from gbk file
         if size is None and self.seq_file is not None:
             try:
@@ -347,9 +455,9 @@ class PlasmidParser:
 def main():
     """A test function that shows how PlasmidParser works"""
     id_list = [142175, 1, 42888, 42876, 26248, 186478, 22222, 25716]
-    PlasmidParser(id=id_list)
+    parser = PlasmidParser(id=id_list)
     plasmids_for_test = {}
-    for plasmid in PlasmidParser.plasmid_list:
+    for plasmid in parser.plasmid_list:
         plasmids_for_test.update({plasmid.name: plasmid})
     for k, v in plasmids_for_test.items():
         print(f"{k}: {v}")
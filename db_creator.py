@@ -2,6 +2,9 @@
 This is a table creator in your database for plasmid-search-engine
 """
 
+import csv
+import io
+
 import Addgene_parser
 import psycopg2
 
@@ -25,49 +28,54 @@ def get_connection():
 
 
 def make_sql_style(plasmid: Addgene_parser.Plasmid) -> Addgene_parser.Plasmid:
-    """Transform from Python's none to empty string and check for "'" sign
-     and converts plasmid's sequnce into 16bit array"""
-    for key, value in plasmid.__dict__.items():
-        if isinstance(value, str):
-            for letter in value:
-                if letter == "'":
-                    setattr(plasmid, f'{key}', "''".join(value.split("'")))  # removing "'" problem
-    if isinstance(plasmid.sequence, (bytes, bytearray)):
-        plasmid.sequence = plasmid.sequence.decode('utf-8')
+    """Normalize a plasmid for loading; the sequence is kept as raw bytes for the BYTEA column"""
+    if isinstance(plasmid.sequence, str):
+        plasmid.sequence = plasmid.sequence.encode('utf-8')
     return plasmid
 
 
-def create_table(id_list: list):
-    print(f'Connecting to the database {DATABASE_CONFIG.get("database")}')
-    with get_connection() as conn:
-        Addgene_parser.PlasmidParser(id=id_list)
-        for plasmid in Addgene_parser.PlasmidParser.plasmid_list:
-            create_record(plasmid, conn)
-            conn.commit()
-        Addgene_parser.PlasmidParser.plasmid_list.clear()  # clear the cash of the parser
+CREATE_TABLE_SQL = (
+    "CREATE TABLE IF NOT EXISTS addgene_plasmids " +
+    "(id INT PRIMARY KEY, name TEXT, size INT, backbone TEXT, vector_type TEXT, marker TEXT, resistance TEXT, " +
+    "growth_t TEXT, growth_strain TEXT, growth_instructions TEXT, copy_num TEXT, gene_insert TEXT, url TEXT, "
+    "sequence BYTEA)")
 
-    print(f'Disconnecting from database {DATABASE_CONFIG.get("database")}')
+COPY_SQL = "COPY addgene_plasmids_load FROM STDIN WITH (FORMAT csv, DELIMITER E'\t', NULL '\\N')"
+
+UPSERT_SQL = "INSERT INTO addgene_plasmids SELECT * FROM addgene_plasmids_load ON CONFLICT (id) DO NOTHING"
 
 
-def create_record(plasmid: Addgene_parser.Plasmid, conn):
+def plasmid_record(plasmid: Addgene_parser.Plasmid) -> tuple:
+    """Build the value tuple of one plasmid for the batched INSERT"""
     plasmid = make_sql_style(plasmid)
+    # COPY in csv form takes BYTEA values in the \x hex input format
+    sequence = None if plasmid.sequence is None else '\\x' + bytes(plasmid.sequence).hex()
+    return (plasmid.id, plasmid.name, plasmid.size, plasmid.backbone, plasmid.vector_type, plasmid.marker,
+            plasmid.resistance, plasmid.growth_t, plasmid.growth_strain, plasmid.growth_instructions,
+            plasmid.copy_num, plasmid.gene_insert, plasmid.url, sequence,)
 
-    cursor = conn.cursor()
-    cursor.execute(
-        "CREATE TABLE IF NOT EXISTS addgene_plasmids " +
-        "(id INT PRIMARY KEY, name TEXT, size INT, backbone TEXT, vector_type TEXT, marker TEXT, resistance TEXT, " +
-        "growth_t TEXT, growth_strain TEXT, growth_instructions TEXT, copy_num TEXT, gene_insert TEXT, url TEXT, "
-        "sequence TEXT)")
-    cursor.execute(
-        f"INSERT INTO addgene_plasmids (id, name, size, backbone, vector_type, marker, resistance, growth_t, " +
-        f"growth_strain, growth_instructions, copy_num, gene_insert, url, sequence)" +
-        f"  VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-        (plasmid.id, plasmid.name, plasmid.size, plasmid.backbone, plasmid.vector_type, plasmid.marker,
-         plasmid.resistance, plasmid.growth_t, plasmid.growth_strain, plasmid.growth_instructions,
-         plasmid.copy_num, plasmid.gene_insert, plasmid.url, plasmid.sequence,))
-
-    print(f"Plasmid {plasmid.id}, {plasmid.name} has been added to {DATABASE_CONFIG.get('database')}.")
-    cursor.close()
+
+def create_table(id_list: list):
+    print(f'Connecting to the database {DATABASE_CONFIG.get("database")}')
+    with get_connection() as conn:
+        parser = Addgene_parser.PlasmidParser(id=id_list)
+        cursor = conn.cursor()
+        cursor.execute(CREATE_TABLE_SQL)
+        rows = [plasmid_record(plasmid) for plasmid in parser.plasmid_list]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter='\t', lineterminator='\n')
+        for row in rows:
+            writer.writerow(['\\N' if value is None else value for value in row])
+        buffer.seek(0)
+        # COPY into a temp table first so duplicate ids cannot abort the stream
+        cursor.execute("CREATE TEMP TABLE addgene_plasmids_load (LIKE addgene_plasmids) ON COMMIT DROP")
+        cursor.copy_expert(COPY_SQL, buffer)
+        cursor.execute(UPSERT_SQL)
+        conn.commit()
+        cursor.close()
+        print(f"{len(rows)} plasmids have been added to {DATABASE_CONFIG.get('database')}.")
+
+    print(f'Disconnecting from database {DATABASE_CONFIG.get("database")}')
 
 
 def main():
@@ -1,10 +1,11 @@
 { pkgs ? import <nixpkgs> {} }:
 let
   my-python-packages = ps: with ps; [
-    pandas
+    aiohttp
+    lxml
     requests
     beautifulsoup4
-    numpy    
+    numpy
     # other python packages
   ];
   my-python = pkgs.python3.withPackages my-python-packages;